@@ -1,144 +1,266 @@
 from __future__ import annotations
 
 import os
-import ctypes
 import socket
+import sys as _sys
+import struct as _struct
 import logging as _logging
-import itertools as _itertools
+import heapq as _heapq
+import functools as _functools
+import collections as _collections
+import weakref as _weakref
+import threading as _threading
 
 from array import array as _array
-from types import FunctionType
-# from inspect import signature, Parameter
+from types import MethodType as _MethodType
 
-from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 
+# lxml parses protocol files faster, but is optional:
+try:
+    from lxml import etree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
 __version__ = 0.3
 
+# Output is left to the application's logging configuration:
 logger = _logging.getLogger('wayland')
-logger.addHandler(_logging.StreamHandler())
+logger.addHandler(_logging.NullHandler())
+
+
+class ProtocolError(ConnectionError):
+    """The server sent a message that is not valid for the Wayland protocol"""
 
 
 ##################################
 #    Data types and structures
 ##################################
 
-class Array(ctypes.Structure):
-    _pack_ = True
-    _fields_ = [('length', ctypes.c_uint32),    # size 4
-                ('value', ctypes.c_char * 28)]  # size 28
+# Message headers are 8 bytes: the object id, and a 32-bit word that holds
+# the total message size in the upper 16 bits, and the opcode in the lower:
+_header = _struct.Struct('=II')
 
-    def __init__(self, text: str):
-        assert len(text) <= 28
-        super().__init__(len(text), text.encode())
+_int = _struct.Struct('=i')
+_uint = _struct.Struct('=I')
 
-    def __repr__(self):
-        return f"{self.__class__.__name__}(len={self.length}, text='{self.value.decode()}')"
+# Strings and arrays are padded to 32-bit boundaries, indexed by (-length & 3):
+_padding = (b'', b'\x00', b'\x00\x00', b'\x00\x00\x00')
 
 
-class String(ctypes.Structure):
-    _fields_ = [('length', ctypes.c_uint32),    # size 4
-                ('value', ctypes.c_char * 27),  # size 27
-                ('null', ctypes.c_byte)]        # size 1
+def _pack_fixed(value: float) -> bytes:
+    # Fixed values are signed 24.8 fixed-point numbers (wl_fixed_t).
+    # Round to the nearest value, the same as wl_fixed_from_double:
+    return _int.pack(round(value * 256))
 
-    def __init__(self, text: str):
-        assert len(text) <= 27
-        super().__init__(len(text) + 1, text.encode())
 
-    def __repr__(self):
-        return f"{self.__class__.__name__}(len={self.length}, text='{self.value.decode()}')"
+# The same strings, such as interface names, are commonly sent many times:
+@_functools.lru_cache(maxsize=128)
+def _pack_string(value: str | None) -> bytes:
+    # Strings are null terminated, and null strings have a length of 0:
+    if value is None:
+        return _uint.pack(0)
+    data = value.encode() + b'\x00'
+    length = len(data)
+    return _uint.pack(length) + data + _padding[-length & 3]
 
 
-class Fixed(ctypes.Structure):
-    _fields_ = [('_value', ctypes.c_uint32)]    # size 32
+def _pack_array(value: bytes) -> bytes:
+    length = len(value)
+    return _uint.pack(length) + bytes(value) + _padding[-length & 3]
 
-    def __init__(self, value):
-        v = (int(value) << 8) + int((value % 1.0) * 256)
-        super().__init__(v)
 
-    def __int__(self):
-        return int((self._value >> 8) + (self._value & 0xff) / 256.0)
+def _pack_array_into(buffer: bytearray, offset: int, value: bytes) -> int:
+    """Pack an array directly into a buffer, returning the new offset"""
+    length = len(value)
+    _uint.pack_into(buffer, offset, length)
+    offset += _uint.size
+    buffer[offset:offset + length] = value
+    offset += length
+    padding = -length & 3
+    buffer[offset:offset + padding] = _padding[padding]
+    return offset + padding
 
-    def __float__(self):
-        return (self._value >> 8) + (self._value & 0xff) / 256.0
 
-    def __repr__(self):
-        return f"{self.__class__.__name__}({float(self)})"
+def _unpack_int(buffer, offset: int, fds) -> tuple[int, int]:
+    return _int.unpack_from(buffer, offset)[0], offset + _int.size
 
 
-class Header(ctypes.Structure):
-    _pack_ = True
-    _fields_ = [('id', ctypes.c_uint32),        # size 4
-                ('opcode', ctypes.c_uint16),    # size 2
-                ('size', ctypes.c_uint16)]      # size 2
+def _unpack_uint(buffer, offset: int, fds) -> tuple[int, int]:
+    return _uint.unpack_from(buffer, offset)[0], offset + _uint.size
 
-    def __add__(self, other: bytes) -> bytes:
-        return bytes(self) + other  # type: ignore
 
-    def __repr__(self) -> str:
-        return f"Header(id={self.id}, opcode={self.opcode}, size={self.size})"
-
-
-_argument_types = {
-    'int':      ctypes.c_int32,
-    'uint':     ctypes.c_uint32,
-    'fixed':    Fixed,
-    'string':   String,
-    'object':   ctypes.c_uint32,
-    'new_id':   ctypes.c_uint32,
-    'array':    Array,
-    'fd':       ctypes.c_int32
-}
+def _unpack_fixed(buffer, offset: int, fds) -> tuple[float, int]:
+    return _int.unpack_from(buffer, offset)[0] / 256.0, offset + _int.size
+
+
+def _unpack_string(buffer, offset: int, fds) -> tuple[str | None, int]:
+    length = _uint.unpack_from(buffer, offset)[0]
+    offset += _uint.size
+    if length == 0:
+        return None, offset
+    # The length includes the null terminator, which is not decoded:
+    return str(buffer[offset:offset + length - 1], 'utf-8'), offset + length + (-length & 3)
 
 
-# _python_types = {
-#     'int':      int,
-#     'uint':     int,
-#     'fixed':    float,
-#     'string':   str,
-#     'object':   int,
-#     'new_id':   int,
-#     'array':    str,
-#     'fd':       int
-# }
+def _unpack_array(buffer, offset: int, fds) -> tuple[bytes, int]:
+    length = _uint.unpack_from(buffer, offset)[0]
+    offset += _uint.size
+    return bytes(buffer[offset:offset + length]), offset + length + (-length & 3)
+
+
+def _unpack_fd(buffer, offset: int, fds) -> tuple[int, int]:
+    # File descriptors are received as ancillary data, in message order:
+    if not fds:
+        raise ProtocolError("A received message is missing a file descriptor")
+    return fds.popleft(), offset
+
+
+# Arguments store a small integer tag, which indexes into _argument_types:
+_argument_tags = {
+    'int':      0,
+    'uint':     1,
+    'fixed':    2,
+    'string':   3,
+    'object':   4,
+    'new_id':   5,
+    'array':    6,
+    'fd':       7
+}
+
+# The Python type of the values that each Argument type accepts:
+_argument_types = (
+    int,                # int
+    int,                # uint
+    float,              # fixed
+    str,                # string
+    int,                # object
+    int,                # new_id
+    bytes,              # array
+    int                 # fd
+)
+
+# struct format characters, for Argument types that have a fixed size:
+_argument_formats = (
+    'i',                # int
+    'I',                # uint
+    'i',                # fixed
+    None,               # string
+    'I',                # object
+    'I',                # new_id
+    None,               # array
+    None                # fd (sent as ancillary data)
+)
+
+_argument_packers = (
+    _int.pack,          # int
+    _uint.pack,         # uint
+    _pack_fixed,        # fixed
+    _pack_string,       # string
+    _uint.pack,         # object
+    _uint.pack,         # new_id
+    _pack_array,        # array
+    _int.pack           # fd
+)
+
+_argument_unpackers = (
+    _unpack_int,        # int
+    _unpack_uint,       # uint
+    _unpack_fixed,      # fixed
+    _unpack_string,     # string
+    _unpack_uint,       # object
+    _unpack_uint,       # new_id
+    _unpack_array,      # array
+    _unpack_fd          # fd
+)
+
+
+# Limits for the Client request queue, after which it is flushed automatically.
+# The fd limit matches the maximum number that libwayland will send or receive
+# at once, and is also used to size the Client's ancillary receive buffer:
+_out_buffer_size = 65536
+_max_pending_fds = 28
+
+# The message size field of the header is 16 bits:
+_max_message_size = 0xffff
+
+# Object IDs from this value upwards are allocated by the server:
+_server_id_start = 0xff000000
+
+# Size of the Client receive buffer. Wayland messages are at most 4096 bytes:
+_recv_buffer_size = 65536
+
+# Requested size of the kernel socket buffers. The kernel may limit this:
+_socket_buffer_size = 262144
 
 
 class _ObjectSpace:
     pass
 
 
+@_functools.lru_cache(maxsize=32)
+def _load_protocol_file(filename: str, mtime: int) -> tuple[str, str, tuple]:
+    """Parse a protocol file, and return its name, copyright and interfaces.
+
+    The interfaces are a tuple of (name, Element) pairs in opcode order.
+    The modification time is part of the cache key, so that a file is
+    parsed again if it changes. The cache only helps when more than one
+    Client loads the same file, and it deliberately keeps the parsed
+    interface elements alive until they are evicted. They are shared by
+    every Protocol created from the same file, and must not be modified.
+    """
+    root = ElementTree.parse(filename).getroot()
+    interfaces = tuple((_sys.intern(element.get('name')), element) for element in root.findall('interface'))
+    return root.get('name'), getattr(root.find('copyright'), 'text', ""), interfaces
+
+
+def _parse_description(element: Element) -> tuple[str, str]:
+    """Return the (description, summary) of an Element, in a single pass."""
+    description = element.find('description')
+    if description is None:
+        return "", ""
+    return description.text or "", description.get('summary', "")
+
+
 ##################################
 #      Wayland abstractions
 ##################################
 
 class Argument:
+    __slots__ = ('name', 'type_name', 'tag', 'summary', 'interface', 'allow_null', 'enum', '_pack')
+
+    def __init__(self, element):
+        attrib = element.attrib
+        self.name = _sys.intern(attrib['name'])
+        self.type_name = _sys.intern(attrib['type'])
+        self.tag = _argument_tags[self.type_name]
+        self.summary = attrib.get('summary')
+        # Optional attributes, for object/new_id and enum arguments:
+        self.interface = attrib.get('interface')
+        self.allow_null = attrib.get('allow-null') == 'true'
+        self.enum = attrib.get('enum')
+        self._pack = _argument_packers[self.tag]
 
-    def __init__(self, parent, element):
-        self._parent = parent
-        self._element = element
-        self.name = element.get('name')
-        self.type_name = element.get('type')
-        self.type = _argument_types[self.type_name]
-        # self.python_type = _python_types[self.type_name]
-        self.summary = element.get('summary')
+    @property
+    def type(self):
+        return _argument_types[self.tag]
 
     def __call__(self, value) -> bytes:
-        # TODO: This tries to convert the argument value (a class) into bytes:
-        print(self.name, value, self.type)
-        return bytes(self.type(value))
+        return self._pack(value)
 
     def __repr__(self) -> str:
         return f"{self.name}({self.type_name}={self.type.__name__})"
 
 
 class Enum:
+    __slots__ = ('_interface', 'name', 'description', 'summary', 'bitfield',
+                 '_entries', '_summaries', '_names', '_bit_names')
+
     def __init__(self, interface, element):
         self._interface = interface
-        self._element = element
 
-        self.name = element.get('name')
-        self.description = getattr(element.find('description'), 'text', "")
-        self.summary = element.find('description').get('summary') if self.description else ""
+        self.name = _sys.intern(element.get('name'))
+        self.description, self.summary = _parse_description(element)
 
         self.bitfield = element.get('bitfield', 'false')
 
@@ -146,157 +268,338 @@ class Enum:
         self._summaries = {}
 
         for entry in element.findall('entry'):
-            name = entry.get('name')
-            value = int(entry.get('value'), base=0)
-            summary = entry.get('summary')
+            attrib = entry.attrib
+            name = _sys.intern(attrib['name'])
+            # Values are either plain decimal, or hexadecimal:
+            value = attrib['value']
+            value = int(value, 16) if value[:2] in ('0x', '0X') else int(value)
             self._entries[value] = name
-            self._summaries[name] = summary
+            self._summaries[name] = attrib.get('summary')
 
-        # TODO: item access, including bitfield
+        # Most enums have a small number of values starting from 0, so their
+        # names can be looked up by indexing a tuple. Bitfield names are
+        # indexed by bit position instead:
+        if self._entries and 0 <= min(self._entries) and max(self._entries) < 64:
+            self._names = tuple(self._entries.get(i) for i in range(max(self._entries) + 1))
+        else:
+            self._names = None
+
+        if self.bitfield == 'true':
+            bit_count = max(self._entries, default=0).bit_length()
+            self._bit_names = tuple(self._entries.get(1 << i) for i in range(bit_count))
+        else:
+            self._bit_names = ()
+
+    def __getitem__(self, value: int) -> str:
+        """Return the name of an enum value"""
+        if self._names is not None and 0 <= value < len(self._names):
+            name = self._names[value]
+            if name is not None:
+                return name
+        return self._entries[value]
+
+    def decode_bits(self, bits: int) -> list[str]:
+        """Return the names of all bits that are set in a bitfield value"""
+        names = []
+        bit_names = self._bit_names
+        while bits:
+            lowest = bits & -bits
+            index = lowest.bit_length() - 1
+            if index >= len(bit_names) or bit_names[index] is None:
+                raise ValueError(f"{lowest:#x} is not a valid bit for enum '{self.name}'")
+            names.append(bit_names[index])
+            bits ^= lowest
+        return names
 
     def __repr__(self):
         return f"{self.__class__.__name__}('{self.name}')"
 
 
 class Event:
+    __slots__ = ('_interface', 'opcode', 'name', 'description', 'summary', 'arguments',
+                 '_struct', '_fixed_indices', '_unpackers', '_new_ids')
+
     def __init__(self, interface, element, opcode):
         self._interface = interface
-        self._element = element
         self.opcode = opcode
 
-        self.name = element.get('name')
-        self.description = getattr(element.find('description'), 'text', "")
-        self.summary = element.find('description').get('summary') if self.description else ""
+        self.name = _sys.intern(element.get('name'))
+        self.description, self.summary = _parse_description(element)
 
-        self.arguments = [Argument(self, element) for element in element.findall('arg')]
+        self.arguments = [Argument(arg) for arg in element.findall('arg')]
+
+        # Events with only fixed size arguments are unpacked with a single Struct.
+        # Otherwise, each argument is unpacked in turn by its type's unpacker:
+        formats = [_argument_formats[argument.tag] for argument in self.arguments]
+        if None in formats:
+            self._struct = None
+            self._unpackers = tuple(_argument_unpackers[argument.tag] for argument in self.arguments)
+        else:
+            self._struct = _struct.Struct("=" + "".join(formats))
+            self._unpackers = ()
+        self._fixed_indices = tuple(i for i, argument in enumerate(self.arguments) if argument.type_name == 'fixed')
+        # Objects created by the server, as (argument index, interface name):
+        self._new_ids = tuple((i, argument.interface) for i, argument in enumerate(self.arguments)
+                              if argument.type_name == 'new_id' and argument.interface)
+
+    def _unpack(self, payload: memoryview, fds) -> tuple:
+        """Unpack the argument values of a received message payload"""
+        if self._struct is None:
+            values = []
+            offset = 0
+            for unpacker in self._unpackers:
+                value, offset = unpacker(payload, offset, fds)
+                values.append(value)
+            return tuple(values)
+
+        values = self._struct.unpack_from(payload)
+        if self._fixed_indices:
+            values = list(values)
+            for i in self._fixed_indices:
+                values[i] /= 256.0
+            values = tuple(values)
+        return values
 
     def __repr__(self):
         return f"{self.name}(opcode={self.opcode}, args=[{', '.join((f'{a}' for a in self.arguments))}])"
 
 
 class _RequestBase:
-    """Request base class"""
+    """Request base class
 
-    arguments: list
+    Requests are created once per Interface class, and stored on it
+    as descriptors. When accessed from an Interface instance, they
+    are bound to it in the same way as regular Python methods.
+    """
+    __slots__ = ('_client', 'opcode', 'name', 'description', 'summary', 'arguments')
 
-    def __init__(self, interface, element, opcode):
-        self._interface = interface
-        self._client = interface.protocol.client
+    def __init__(self, protocol, element, opcode):
+        self._client = protocol.client
         self.opcode = opcode
 
-        self.name = element.get('name')
-        self.description = getattr(element.find('description'), 'text', "")
-        self.summary = element.find('description').get('summary') if self.description else ""
-
-    def _send(self, bytestring, *fds):
-        # Headers are 8 bytes
-        size = ctypes.sizeof(Header) + len(bytestring)
+        self.name = _sys.intern(element.get('name'))
+        self.description, self.summary = _parse_description(element)
 
-        header = Header(id=self._interface.id, opcode=self.opcode, size=size)
+        # Arguments are callable objects that type cast and return bytes:
+        self.arguments = [Argument(arg) for arg in element.findall('arg')]
 
-        request = header + bytestring
-        print(f"{self.name} sent message: {request}, {header}")
-
-        self._client.send_request(self, request, *fds)
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return _MethodType(self, instance)
 
     def __repr__(self):
         return f"{self.name}(opcode={self.opcode}, args=[{', '.join((f'{a}' for a in self.arguments))}])"
 
 
-# class Request:
-#
-#     def __init__(self, interface, element, opcode, arguments):
-#         self._client = interface.protocol.client
-#         self.opcode = opcode
-#         self.arguments = arguments
-#
-#         self.name = element.get('name')
-#         self.description = getattr(element.find('description'), 'text', "")
-#         self.summary = element.find('description').get('summary') if self.description else ""
-#
-#     def _send(self, bytestring):
-#         # TODO: Complete this method
-#
-#         # Headers are 8 bytes
-#         size = 8 + len(bytestring)
-#         # header = Header(id=???, opcode=self.opcode, size=size)
-#         #
-#         # request = header +
-#         #
-#         # self._client.send_request(self, request, *fds)
-#
-#     # def __call__(self, *args) -> bytes:
-#     #     return b''.join(self.arguments[i](value) for i, value in enumerate(args))
-#
-#     def __repr__(self):
-#         return f"{self.name}(opcode={self.opcode}, args=[{', '.join((f'{a}' for a in self.arguments))}])"
+def _request_source(request: _RequestBase, namespace: dict) -> str:
+    """Generate the source of a Request's __call__ method
+
+    The generated method packs the message header and all fixed size
+    arguments with a single precompiled Struct. Strings and arrays are
+    variable length, so Requests that contain them pack each run of
+    fixed size arguments separately. All parts are packed directly
+    into the Client output buffer. File descriptors are not part of
+    the message body, and are passed on to the Client to be sent as
+    ancillary data. Any Structs used by the method are added to the
+    `namespace` that the source will be executed in.
+    """
+    opcode = request.opcode
+
+    # Group the arguments into runs of fixed size (format, value) pairs,
+    # and (type name, argument name) tuples for strings and arrays:
+    parts = []
+    fds = []
+    parameters = []
+    for argument in request.arguments:
+        if argument.type_name == 'new_id' and not argument.interface:
+            # A new_id without a fixed interface, such as in `wl_registry.bind`,
+            # is sent as the interface name and version, followed by the id:
+            interface_name, version = f"{argument.name}_interface", f"{argument.name}_version"
+            parameters.extend((interface_name, version, argument.name))
+            parts.append(('string', interface_name))
+            parts.append([('I', version), ('I', argument.name)])
+            continue
+
+        parameters.append(argument.name)
+        if argument.type_name == 'fd':
+            fds.append(argument.name)
+        elif argument.type_name in ('string', 'array'):
+            parts.append((argument.type_name, argument.name))
+        else:
+            value = f"round({argument.name} * 256)" if argument.type_name == 'fixed' else argument.name
+            if not parts or isinstance(parts[-1], tuple):
+                parts.append([])
+            parts[-1].append((_argument_formats[argument.tag], value))
+
+    fd_string = f"({', '.join(fds)},)" if fds else "()"
+
+    # Messages are packed directly into the Client output buffer, at the offset
+    # returned by `_reserve`. Local names start with an underscore, to avoid
+    # clashing with argument names.
+    if all(isinstance(part, list) for part in parts):
+        # Only fixed size arguments, so pack everything at once:
+        fixed = parts[0] if parts else []
+        packer = _struct.Struct(_header.format + "".join(fmt for fmt, _ in fixed))
+        namespace[f"_packer{opcode}"] = packer
+        values = "".join(f", {value}" for _, value in fixed)
+        # The opcode and message size are constant, so are written as a literal:
+        header = f"_interface.id, {(packer.size << 16) | opcode}"
+        # If packing fails, the reserved space and fds are released again:
+        body = (f"    _client = self._client\n"
+                f"    with _client._lock:\n"
+                f"        _offset = _client._reserve({packer.size}, {fd_string})\n"
+                f"        try:\n"
+                f"            _packer{opcode}.pack_into(_client._out_buf, _offset, {header}{values})\n"
+                f"        except BaseException:\n"
+                f"            _client._cancel(_offset, {len(fds)})\n"
+                f"            raise")
+        # Final source code should look something like:
+        #
+        #   def request_name(self, _interface, argument1, argument2):
+        #       _client = self._client
+        #       with _client._lock:
+        #           _offset = _client._reserve(16, ())
+        #           try:
+        #               _packer2.pack_into(_client._out_buf, _offset, _interface.id, 1048578, argument1, argument2)
+        #           except BaseException:
+        #               _client._cancel(_offset, 0)
+        #               raise
+    else:
+        # Strings are packed first, to calculate the size. Arrays are packed
+        # directly into the buffer, with a size of (4 + length) padded to 4:
+        lines = []
+        size = _header.size
+        size_string = ""
+        for i, part in enumerate(parts):
+            if isinstance(part, list):
+                packer = _struct.Struct("=" + "".join(fmt for fmt, _ in part))
+                namespace[f"_packer{opcode}_{i}"] = packer
+                size += packer.size
+            elif part[0] == 'string':
+                lines.append(f"    _part{i} = _pack_string({part[1]})\n")
+                size_string += f" + len(_part{i})"
+            else:
+                size_string += f" + ((len({part[1]}) + 7) & ~3)"
+        # The lock is held from reserving the space until the message is complete.
+        # If packing fails, the reserved space and fds are released again:
+        lines.append(f"    _size = {size}{size_string}\n"
+                     f"    if _size > {_max_message_size}:\n"
+                     f"        raise ValueError(f\"Message size of {{_size}} bytes exceeds the maximum\")\n"
+                     f"    _client = self._client\n"
+                     f"    with _client._lock:\n"
+                     f"        _start = _offset = _client._reserve(_size, {fd_string})\n"
+                     f"        try:\n"
+                     f"            _buffer = _client._out_buf\n"
+                     f"            _header.pack_into(_buffer, _offset, _interface.id, (_size << 16) | {opcode})\n"
+                     f"            _offset += {_header.size}\n")
+        for i, part in enumerate(parts):
+            if isinstance(part, tuple) and part[0] == 'string':
+                lines.append(f"            _buffer[_offset:_offset + len(_part{i})] = _part{i}\n"
+                             f"            _offset += len(_part{i})\n")
+            elif isinstance(part, tuple):
+                lines.append(f"            _offset = _pack_array_into(_buffer, _offset, {part[1]})\n")
+            else:
+                values = ", ".join(value for _, value in part)
+                lines.append(f"            _packer{opcode}_{i}.pack_into(_buffer, _offset, {values})\n"
+                             f"            _offset += {namespace[f'_packer{opcode}_{i}'].size}\n")
+        lines.append(f"        except BaseException:\n"
+                     f"            _client._cancel(_start, {len(fds)})\n"
+                     f"            raise\n")
+        body = "".join(lines)
+        # Final source code should look something like:
+        #
+        #   def request_name(self, _interface, argument1, argument2):
+        #       _part1 = _pack_string(argument2)
+        #       _size = 12 + len(_part1)
+        #       if _size > 65535:
+        #           raise ValueError(f"Message size of {_size} bytes exceeds the maximum")
+        #       _client = self._client
+        #       with _client._lock:
+        #           _start = _offset = _client._reserve(_size, ())
+        #           try:
+        #               _buffer = _client._out_buf
+        #               _header.pack_into(_buffer, _offset, _interface.id, (_size << 16) | 2)
+        #               _offset += 8
+        #               _packer2_0.pack_into(_buffer, _offset, argument1)
+        #               _offset += 4
+        #               _buffer[_offset:_offset + len(_part1)] = _part1
+        #               _offset += len(_part1)
+        #           except BaseException:
+        #               _client._cancel(_start, 0)
+        #               raise
+
+    signature = ", ".join(["self", "_interface", *parameters])
+    return f"def {request.name}({signature}):\n{body}\n"
+
+
+def _create_requests(protocol: Protocol, element: Element) -> tuple:
+    """Dynamically create the `request` methods of an Interface
+
+    This function parses the xml element of an `interface` definition,
+    and dynamically creates callable Request classes for each `request`.
+    The __call__ methods of all Requests are generated as the source of
+    a single module, which is executed once. The Request instances are
+    then assigned by name to the Interface class, allowing them to be
+    called like normal Python methods.
+    """
+    requests = []
+    for opcode, request_element in enumerate(element.findall('request')):
+        request_class = type(_sys.intern(request_element.get('name')), (_RequestBase,), {'__slots__': ()})
+        requests.append(request_class(protocol=protocol, element=request_element, opcode=opcode))
+
+    namespace = {'_header': _header, '_pack_string': _pack_string, '_pack_array_into': _pack_array_into}
+    source = "\n".join(_request_source(request, namespace) for request in requests)
+    exec(source, namespace)
+
+    for request in requests:
+        type(request).__call__ = namespace[request.name]
+
+    return tuple(requests)
 
 
 class _InterfaceBase:
-    """Interface base class"""
+    """Interface base class
+
+    Interface classes are created dynamically by each Protocol. All
+    data parsed from the xml element is the same for every instance,
+    so it is done once per class in `__init_subclass__`. The element
+    is passed as a class keyword argument, and is not kept afterwards.
+    """
+    __slots__ = ('id',)
 
-    _element: Element
+    _enums: dict
+    _events: tuple
+    _events_by_name: dict
+    _requests: tuple
+    _requests_by_name: dict
     protocol: Protocol
     opcode: int
+    version: int
+    description: str
+    summary: str
 
-    def __init__(self, oid: int):
-        self.id = oid
-        self.version = int(self._element.get('version'), 0)
+    def __init_subclass__(cls, element: Element, **kwargs):
+        super().__init_subclass__(**kwargs)
 
-        self.description = getattr(self._element.find('description'), 'text', "")
-        self.summary = self._element.find('description').get('summary') if self.description else ""
+        cls.version = int(element.get('version'), 0)
+        cls.description, cls.summary = _parse_description(element)
 
-        # TODO: do enums have opcodes?
-        self._enums = [Enum(self, element) for element in self._element.findall('enum')]
-        self._events = [Event(self, element, opc) for opc, element in enumerate(self._element.findall('event'))]
+        # Enums have no opcodes, and are referred to by name:
+        enums = (Enum(cls, elem) for elem in element.findall('enum'))
+        cls._enums = {enum.name: enum for enum in enums}
+        # Events and Requests are stored in opcode order, for direct lookup,
+        # and also mapped by name:
+        cls._events = tuple(Event(cls, elem, opc) for opc, elem in enumerate(element.findall('event')))
+        cls._events_by_name = {event.name: event for event in cls._events}
+        cls._requests = _create_requests(cls.protocol, element)
+        cls._requests_by_name = {request.name: request for request in cls._requests}
 
-        for request in self._create_requests():
-            setattr(self, request.name, request)
+        for request in cls._requests:
+            setattr(cls, request.name, request)
 
-    def _create_requests(self):
-        """Dynamically create `request` methods
-
-        This method parses the xml element for `request` definitions,
-        and dynamically creates callable Reqest classes from them. These
-        Request instances are then assigned by name to the Interface,
-        allowing them to be called like a normal Python methods.
-        """
-        for i, element in enumerate(self._element.findall('request')):
-            request_name = element.get('name')
-
-            # Arguments are callable objects that type cast and return bytes:
-            arguments = [Argument(self, arg) for arg in element.findall('arg')]
-
-            # Create a dynamic __call__ method with correct signature:
-            signature = "self, " + ", ".join(arg.name for arg in arguments)
-            call_string = " + ".join(f"arguments[{i}]({arg.name})" for i, arg in enumerate(arguments))
-            source = f"def {request_name}({signature}):\n    self._send({call_string})"
-            # Final source code should look something like:
-            #
-            #   def request_name(self, argument1, argument2):
-            #       self._send(arguments[0](argument1) + arguments[1](argument2))
-
-            # print(source, '\n')
-
-            compiled_code = compile(source=source, filename="<string>", mode="exec")
-            method = FunctionType(compiled_code.co_consts[0], locals(), request_name)
-
-            # Create a dynamic Request class which includes the custom __call__ method:
-            request_class = type(request_name, (_RequestBase,), {'__call__': method, 'arguments': arguments})
-
-            yield request_class(interface=self, element=element, opcode=i)
-
-            # def _call(self, *args) -> bytes:
-            #     return b''.join(self.arguments[_i](value) for _i, value in enumerate(args))
-            #
-            # # request = Request(interface=self, element=element, opcode=i, arguments=arguments)
-            # request_class = type(request_name, (Request,), {'__call__': _call})
-            #
-            # sig = signature(_call)
-            # parameters = [Parameter(name=arg.name, kind=Parameter.VAR_POSITIONAL) for arg in arguments]
-            # _call.__signature__ = sig.replace(parameters=parameters)
-            #
-            # yield request_class(interface=self, element=element, opcode=i, arguments=arguments)
+    def __init__(self, oid: int):
+        self.id = oid
 
     def __repr__(self):
         return f"{self.__class__.__name__}(opcode={self.opcode}, id={self.id})"
@@ -307,35 +610,42 @@ class Protocol:
         """A representaion of a Wayland Protocol
 
         Given a Wayland Protocol .xml file, all Interfaces classes will
-        be dynamically generated at runtime.
+        be dynamically generated at runtime. Each class is only created
+        when the Interface is first used, since most applications only
+        use a small number of the defined Interfaces.
         """
 
         self.client = client
-        self._root = ElementTree.parse(filename).getroot()
-
-        self.name = self._root.get('name')
-        self.copyright = getattr(self._root.find('copyright'), 'text', "")
+        # Loaded files are cached, so multiple Clients can share them:
+        self.name, self.copyright, interfaces = _load_protocol_file(filename, os.stat(filename).st_mtime_ns)
 
+        # The interface elements are only kept until their classes are created,
+        # although the file cache holds on to them too. Opcodes are determined
+        # by enumeration order:
+        self._interface_elements = {name: (i, element) for i, (name, element) in enumerate(interfaces)}
         self._interface_classes = {}
 
-        # Iterate over all defined interfaces, and dynamically create
-        # custom Interface classes using the _InterfaceBase class.
-        # Opcodes are determined by enumeration order.
-        for i, element in enumerate(self._root.findall('interface')):
-            name = element.get('name')
-            interface_class = type(name, (_InterfaceBase,), {'protocol': self, '_element': element, 'opcode': i})
-            self._interface_classes[name] = interface_class
+    def _create_interface_class(self, name):
+        """Dynamically create a custom Interface class using the _InterfaceBase class"""
+        opcode, element = self._interface_elements[name]
+        attrs = {'__slots__': (), 'protocol': self, 'opcode': opcode}
+        interface_class = type(name, (_InterfaceBase,), attrs, element=element)
+        self._interface_classes[name] = interface_class
+        # The element is no longer needed by this Protocol:
+        self._interface_elements[name] = (opcode, None)
+        return interface_class
 
     def create_interface(self, name, oid):
-        if name not in self._interface_classes:
+        if name not in self._interface_elements:
             raise NameError(f"This Protocol does not define an interface named '{name}'.\n"
-                            f"Valid interface names are : {list(self._interface_classes)}")
+                            f"Valid interface names are : {list(self._interface_elements)}")
 
-        return self._interface_classes[name](oid=oid)
+        interface_class = self._interface_classes.get(name) or self._create_interface_class(name)
+        return interface_class(oid=oid)
 
     @property
     def interface_names(self):
-        return list(self._interface_classes)
+        return list(self._interface_elements)
 
     def __repr__(self):
         return f"{self.__class__.__name__}('{self.name}')"
@@ -357,6 +667,9 @@ class Client:
 
     When instantiated, the Client automatically creates the main Display
     (`wl_display`) interface, which is available as `Client.wl_display`.
+
+    Requests are queued, and sent to the server together when `flush` is
+    called, or when the queue grows large enough to be sent automatically.
     """
     def __init__(self, *protocols: str):
         """Create a Wayland Client connection.
@@ -374,58 +687,197 @@ class Client:
             _runtime_dir = os.environ.get('XDG_RUNTIME_DIR', default='/run/user/1000')
             path = os.path.join(_runtime_dir, endpoint)
 
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"Wayland endpoint not found: {path}")
-
-        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
-        self._sock.setblocking(False)
-        self._sock.connect(path)
+        # Set the socket flags atomically, rather than with additional syscalls:
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, 0)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _socket_buffer_size)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _socket_buffer_size)
+        try:
+            self._sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            self._sock.close()
+            raise FileNotFoundError(f"Wayland endpoint not found: {path}") from e
+        # Close the socket when the Client is garbage collected:
+        self._finalizer = _weakref.finalize(self, self._sock.close)
 
         self._protocols = dict()
-        self.protocols = _ObjectSpace()
 
         for filename in protocols:
-            if not os.path.exists(filename):
-                raise FileNotFoundError(f"Protocol file was not found: {filename}")
-
             protocol = Protocol(client=self, filename=filename)
             self._protocols[protocol.name] = protocol
-            # Temporary addition for easy access in the REPL:
-            setattr(self.protocols, protocol.name, protocol)
+
+        # Temporary addition for easy access in the REPL:
+        self.protocols = _ObjectSpace()
+        vars(self.protocols).update(self._protocols)
 
         assert 'wayland' in self._protocols, "You must provide at minimum a wayland.xml protocol file."
 
-        # Client side object ID generator:
-        self._oid_generator = _itertools.cycle(range(1, 0xfeffffff))
+        # Client side object IDs. Released IDs are reused, lowest first:
+        self._next_oid = 1
+        self._free_oids = []
 
-        # A mapping of oids to interfaces:
+        # A mapping of oids to interfaces, and to their Events by opcode:
         self._objects = {}
+        self._event_dispatch = {}
+
+        # Requests are packed into the output buffer, and sent by `flush`:
+        self._out_buf = bytearray(_out_buffer_size)
+        self._out_view = memoryview(self._out_buf)
+        self._out_size = 0
+        self._pending_fds = []
+        # Held while a request is packed, or the buffer is flushed, so that
+        # requests from multiple threads are not interleaved:
+        self._lock = _threading.RLock()
+
+        # Receive buffers, which are reused by every call to `select`.
+        # Incomplete messages are kept at the start, until the rest arrives:
+        self._recv_buf = bytearray(_recv_buffer_size)
+        self._recv_view = memoryview(self._recv_buf)
+        self._recv_size = 0
+        self._recv_fds = _collections.deque()
+        self._anc_size = socket.CMSG_SPACE(_max_pending_fds * _array('i').itemsize)
+        # Set when the connection can no longer be used:
+        self._error = None
 
         # Create a global wl_display object:
         self.wl_display = self.create_interface(protocol='wayland', interface='wl_display')
+        # The server confirms deleted objects with this event, so their IDs can be reused:
+        self._delete_id_event = self.wl_display._events_by_name['delete_id']
 
     def _get_next_object_id(self) -> int:
         """Get the next available object ID
 
         """
-        oid = next(self._oid_generator)
-
-        while oid in self._objects:
-            oid = next(self._oid_generator)
+        if self._free_oids:
+            return _heapq.heappop(self._free_oids)
 
+        oid = self._next_oid
+        self._next_oid += 1
         return oid
 
+    def release_object_id(self, oid: int) -> None:
+        """Release an object ID, so that it can be reused
+
+        This is called automatically when the server sends a
+        `wl_display.delete_id` event. Unknown IDs are ignored.
+        """
+        if self._objects.pop(oid, None) is not None:
+            del self._event_dispatch[oid]
+            if oid < _server_id_start:
+                _heapq.heappush(self._free_oids, oid)
+
+    def _add_object(self, interface_instance) -> None:
+        self._objects[interface_instance.id] = interface_instance
+        self._event_dispatch[interface_instance.id] = interface_instance._events
+
+    def _add_server_object(self, oid: int, interface: str) -> None:
+        """Add an object that was created by the server in an event"""
+        for protocol in self._protocols.values():
+            if interface in protocol._interface_elements:
+                self._add_object(protocol.create_interface(name=interface, oid=oid))
+                return
+        # Events for Interfaces that are not in any loaded Protocol can't be dispatched:
+        logger.debug("server created object of unknown interface: oid=%d, %s", oid, interface)
+
     def create_interface(self, protocol: str, interface: str):
         protocol_class = self._protocols[protocol]
 
         object_id = self._get_next_object_id()
         interface_instance = protocol_class.create_interface(name=interface, oid=object_id)
-        self._objects[object_id] = interface_instance
+        self._add_object(interface_instance)
 
         return interface_instance
 
-    def send_request(self, request, *fds):
-        self._sock.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, _array("i", fds))])
+    def _reserve(self, size: int, fds=()) -> int:
+        """Reserve space in the output buffer for a request
+
+        The queue is flushed first if there is not enough space left.
+        Returns the offset that the request should be packed into.
+        File descriptors are duplicated, so the caller is free to
+        close them before the queue is flushed. The caller must hold
+        the Client lock until the request is fully packed.
+        """
+        if self._out_size + size > len(self._out_buf) or len(self._pending_fds) + len(fds) > _max_pending_fds:
+            self.flush()
+            if self._out_size + size > len(self._out_buf) or len(self._pending_fds) + len(fds) > _max_pending_fds:
+                raise BlockingIOError("The request queue is full, and the socket is not ready for writing.")
+
+        offset = self._out_size
+        self._dup_fds(fds)
+        self._out_size += size
+        return offset
+
+    def _dup_fds(self, fds) -> None:
+        """Duplicate fds into the pending list, or none of them if one fails"""
+        pending = self._pending_fds
+        count = len(pending)
+        try:
+            pending.extend(os.dup(fd) for fd in fds)
+        except BaseException:
+            for fd in pending[count:]:
+                os.close(fd)
+            del pending[count:]
+            raise
+
+    def _cancel(self, offset: int, fd_count: int) -> None:
+        """Discard the last reserved request, if it could not be packed
+
+        The output buffer is truncated back to the request's offset, and
+        the last `fd_count` pending file descriptors are closed. The caller
+        must still hold the lock that was held when reserving it.
+        """
+        self._out_size = offset
+        if fd_count:
+            for fd in self._pending_fds[-fd_count:]:
+                os.close(fd)
+            del self._pending_fds[-fd_count:]
+
+    def send_request(self, buffers, fds=()):
+        """Queue the already packed buffers of a request, and any file descriptors"""
+        size = sum(len(buffer) for buffer in buffers)
+        with self._lock:
+            start = offset = self._reserve(size, fds)
+            try:
+                for buffer in buffers:
+                    self._out_view[offset:offset + len(buffer)] = buffer
+                    offset += len(buffer)
+            except BaseException:
+                self._cancel(start, len(fds))
+                raise
+
+    def flush(self):
+        """Send all queued requests to the server
+
+        The output buffer is sent with a single `sendmsg` call, and any
+        file descriptors are sent as SCM_RIGHTS ancillary data. If the
+        socket can not accept all the data, the remainder is kept at the
+        start of the buffer for the next flush. When using an event loop,
+        wait for the socket to be writable while `pending` is True, and
+        call this method again.
+        """
+        with self._lock:
+            if not self._out_size:
+                return
+
+            fds = self._pending_fds
+            ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, _array("i", fds))] if fds else []
+            try:
+                sent = self._sock.sendmsg([self._out_view[:self._out_size]], ancillary)
+            except BlockingIOError:
+                # Nothing was sent, so the fds must be kept for the next attempt:
+                return
+
+            for fd in fds:
+                os.close(fd)
+            fds.clear()
+
+            remaining = self._out_size - sent
+            self._out_buf[:remaining] = self._out_buf[sent:self._out_size]
+            self._out_size = remaining
+
+    @property
+    def pending(self) -> bool:
+        """True if there are queued requests that have not been sent"""
+        return self._out_size > 0
 
     def fileno(self):
         """The fileno of the socket object
@@ -436,19 +888,114 @@ class Client:
         return self._sock.fileno()
 
     def select(self):
-        # TODO: receive events from the server
-        # (data, ancdata, msg_flags, address)
-        data, ancdata, msg_flags, _ = self._sock.recvmsg(1024, socket.CMSG_SPACE(64))
-        print("data, ancdata, msg_flags: ", data, ancdata, msg_flags)
+        """Receive and dispatch events from the server
 
-    def __del__(self):
-        if hasattr(self, '_sock'):
-            self._sock.close()
+        Complete messages that are already in the receive buffer, such as
+        those left after an error was raised, are dispatched first. The
+        socket is only read when no complete message is buffered.
+        """
+        if self._error is not None:
+            raise ProtocolError("The connection can not be used after a fatal error") from self._error
+
+        if not self._message_pending():
+            self._receive()
+        self._dispatch_pending()
+
+    def _fatal_error(self, message: str) -> ProtocolError:
+        """Mark the connection as unusable, and return the error to raise
+
+        Received file descriptors can no longer be matched to messages,
+        so they are all closed.
+        """
+        self._error = ProtocolError(message)
+        while self._recv_fds:
+            os.close(self._recv_fds.popleft())
+        return self._error
+
+    def _message_pending(self) -> bool:
+        """True if the receive buffer starts with a complete message"""
+        if self._recv_size < _header.size:
+            return False
+        return _header.unpack_from(self._recv_buf)[1] >> 16 <= self._recv_size
+
+    def _receive(self):
+        """Read from the socket, appending to the receive buffer"""
+        # (nbytes, ancdata, msg_flags, address)
+        buffers = [self._recv_view[self._recv_size:]]
+        nbytes, ancdata, msg_flags, _ = self._sock.recvmsg_into(buffers, self._anc_size)
+
+        if logger.isEnabledFor(_logging.DEBUG):
+            logger.debug("nbytes=%d, ancdata=%s, msg_flags=%d", nbytes, ancdata, msg_flags)
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds = _array("i")
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+                self._recv_fds.extend(fds)
+
+        self._recv_size += nbytes
+
+        # The kernel discards any fds that don't fit, so the queue can't be trusted:
+        if msg_flags & socket.MSG_CTRUNC:
+            raise self._fatal_error("Received file descriptors were truncated")
+
+    def _dispatch_pending(self):
+        """Dispatch all complete messages in the receive buffer"""
+        # TODO: dispatch events to their interfaces
+        # Only format debug messages if they will actually be logged:
+        debug = logger.isEnabledFor(_logging.DEBUG)
+
+        # Headers are parsed in place, without copying the buffer:
+        end = self._recv_size
+        offset = 0
+        try:
+            while end - offset >= _header.size:
+                oid, size_opcode = _header.unpack_from(self._recv_buf, offset)
+                size = size_opcode >> 16
+                # Sizes include the header, and are always padded to 32-bit boundaries:
+                if size < _header.size or size & 3:
+                    raise ProtocolError(f"Invalid message size of {size} bytes, for object id {oid}")
+                if end - offset < size:
+                    break
+                payload = self._recv_view[offset + _header.size:offset + size]
+                offset += size
+                opcode = size_opcode & 0xffff
+
+                # File descriptors arrive with, or before, the message they belong to.
+                # If a message can't be dispatched while fds are queued, it's unknown
+                # whether they belong to it, so no later fd can be trusted:
+                events = self._event_dispatch.get(oid)
+                if events is None:
+                    if self._recv_fds:
+                        raise self._fatal_error(f"Unknown object id {oid}, with file descriptors queued")
+                    if debug:
+                        logger.debug("received event for unknown object: oid=%d, opcode=%d, %s",
+                                     oid, opcode, bytes(payload))
+                    continue
+
+                if opcode >= len(events):
+                    if self._recv_fds:
+                        raise self._fatal_error(f"Invalid event opcode {opcode}, for object id {oid}")
+                    raise ProtocolError(f"Invalid event opcode {opcode}, for object id {oid}")
+
+                event = events[opcode]
+                arguments = event._unpack(payload, self._recv_fds)
+                if debug:
+                    logger.debug("received event: %s%s", event.name, arguments)
+
+                for index, interface in event._new_ids:
+                    self._add_server_object(arguments[index], interface)
+
+                if event is self._delete_id_event:
+                    self.release_object_id(arguments[0])
+        finally:
+            # Move any unhandled messages to the start of the buffer. This is
+            # also done if an error is raised, so that the next call to
+            # `select` can dispatch the messages that follow it:
+            remaining = end - offset
+            self._recv_buf[:remaining] = self._recv_buf[offset:end]
+            self._recv_size = remaining
 
     def __repr__(self):
         return f"{self.__class__.__name__}(socket='{self._sock.getpeername()}')"
 
-
-# TODO: remove testing code:
-if __name__ == '__main__':
-    client = Client('/usr/share/wayland/wayland.xml')